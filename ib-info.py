@@ -25,10 +25,26 @@ from rich.table import Table
 # XXX How to detect base currency?
 BASE = '€'
 
-def print_data(value):
+# Thousands separator of the current locale, set in main():
+_SEP = ''
+
+# Format an integer with thousands separator. Groups of three digits
+# are used independent of the locale grouping.
+def _fmt_int(value: int) -> str:
+    return f"{value:,}".replace(',', _SEP)
+
+# Round value to an integer, large values in thousands.
+# Returns the rounded value and True if it is in thousands.
+def _scale(value: float) -> tuple[int, bool]:
     if value >= 980000:
-        return locale.format_string("%d", round(value / 1000), grouping=True) + 'T'
-    return locale.format_string("%d", round(value), grouping=True)
+        return int(value + 500) // 1000, True
+    return round(value), False
+
+def print_data(value):
+    scaled, thousands = _scale(value)
+    if thousands:
+        return _fmt_int(scaled) + 'T'
+    return _fmt_int(scaled)
 
 def show_account2(ib):
     #print([v for v in ib.accountValues()
@@ -103,73 +119,45 @@ def show_account(ib, console, verbose):
     if verbose >= 3:
         show_account2(ib)
 
-def usage():
-    print('ib-info.py ' +
-        '[--host=127.0.0.1][--port=7496][--client-id=0]' +
-        '[--help][--verbose][--debug][--quiet]')
+# log level for each verbose level:
+LOG_LEVELS = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)
 
 def main(argv):
-    import getopt
+    global _SEP
+    import argparse
 
     locale.setlocale(locale.LC_ALL, '')
+    _SEP = locale.localeconv()['thousands_sep']
     #locale.setlocale(locale.LC_ALL, 'de_DE')
     #print(locale.getlocale())
     #for key, value in locale.localeconv().items():
     #    print("%s: %s" % (key, value))
     #logger = logging.getLogger(__name__)
 
-    verbose = 1
-
+    parser = argparse.ArgumentParser(prog='ib-info.py',
+        description='Show account information from IB TWS.')
     # Connect params to your Interactive Brokers (IB) TWS or IB Gateway:
-    host = '127.0.0.1'
-    #port = 7497 # TWS paper account (demo/test)
-    port = 7496 # TWS active/real/live account
-    #port = 4002 # IB Gateway paper account (demo/test)
-    #port = 4001 # IB Gateway active/real/live account
-    client_id = 0
-
-    try:
-        opts, args = getopt.getopt(argv, 'dhqv', ['list-index', 'help',
-            'host=', 'port=', 'client-id='
-            'data-dir=', 'quiet', 'verbose', 'debug'])
-    except getopt.GetoptError:
-        usage()
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt in ('-h', '--help'):
-            usage()
-            sys.exit()
-        elif opt == '--host':
-            host = arg
-        elif opt == '--port':
-            port = int(arg)
-        elif opt == '--client-id':
-            client_id = int(arg)
-        elif opt in ('-v', '--verbose'):
-            verbose += 1
-        elif opt in ('-d', '--debug'):
-            verbose = 3
-        elif opt in ('-q', '--quiet'):
-            verbose = 0
-    #if len(args) == 0:
-    #    usage()
-    #    sys.exit()
+    parser.add_argument('--host', default='127.0.0.1')
+    # 7497: TWS paper account (demo/test)
+    # 7496: TWS active/real/live account
+    # 4002: IB Gateway paper account (demo/test)
+    # 4001: IB Gateway active/real/live account
+    parser.add_argument('--port', type=int, default=7496)
+    parser.add_argument('--client-id', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('-d', '--debug', action='store_const', const=3, dest='verbose')
+    parser.add_argument('-q', '--quiet', action='store_const', const=0, dest='verbose')
+    args = parser.parse_args(argv)
+    verbose = args.verbose
 
     ib_async.util.allowCtrlC()
 
-    if verbose == 0:
-        ib_async.util.logToConsole(logging.ERROR)
-    elif verbose == 1:
-        ib_async.util.logToConsole(logging.WARNING)
-    elif verbose == 2:
-        ib_async.util.logToConsole(logging.INFO)
-    elif verbose >= 3:
-        ib_async.util.logToConsole(logging.DEBUG)
+    ib_async.util.logToConsole(LOG_LEVELS[min(verbose, len(LOG_LEVELS) - 1)])
     #ib_async.util.logToFile("ib.log", logging.WARNING)
 
     ib = ib_async.IB()
     try:
-        ib.connect(host, port, clientId=client_id) # account=, timeout=
+        ib.connect(args.host, args.port, clientId=args.client_id) # account=, timeout=
     except ConnectionRefusedError:
         sys.exit(1)
 
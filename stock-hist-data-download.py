@@ -6,13 +6,9 @@
 #
 # Required (tested on Debian 11 and 12):
 # sudo apt-get install python3-pandas
-# pip3 install ib_async
-#
-# Old requirement:
-# sudo apt-get install python3-sqlalchemy-utils
+# pip3 install ib_async pyarrow
 #
 # TODO:
-# - Also support parquet fileformat in addition to csv: pd.read_parquet() pd.to_parquet().
 # - Cache also empty data returns?
 # - Note date of data download and date of last check
 # - Add account id into sql filename?
@@ -32,7 +28,12 @@ import sys
 import os
 import time
 import logging
+import asyncio
+import functools
+import operator
+import pathlib
 
+import numpy
 import pandas
 import ib_async
 
@@ -91,6 +92,9 @@ SP500: tuple[str, ...] = (
     'WMB', 'WMT', 'WRB', 'WRK', 'WST', 'WTW', 'WY', 'WYNN', 'XEL', 'XOM',
     'XRAY', 'XYL', 'YUM', 'ZBH', 'ZBRA', 'ZION', 'ZTS')
 
+# IB uses a space instead of a dot within stock symbols:
+SP500_NORMALIZED: tuple[str, ...] = tuple(s.replace('.', ' ') for s in SP500)
+
 # old stock symbols who got merged, renamed, removed:
 SP500old: tuple[str, ...] = ('FB', 'PVH')
 
@@ -113,10 +117,69 @@ REITS: tuple[str, ...] = ('ARE', 'AMT', 'AVB', 'BXP', 'CPT', 'CBRE', 'CCI',
     'IRM', 'KIM', 'MAA', 'PLD', 'PSA', 'O', 'REG', 'SBAC', 'SPG', 'UDR',
     'VTR', 'VICI', 'VNO', 'WELL', 'WY')
 
+# https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average
+# (exchange, symbol):
+DOW: tuple[tuple[str, str], ...] = (
+    ('NYSE', 'MMM'), ('NYSE', 'AXP'), ('ISLAND', 'AMGN'), ('ISLAND', 'AAPL'),
+    ('NYSE', 'BA'), ('NYSE', 'CAT'), ('NYSE', 'CVX'), ('ISLAND', 'CSCO'),
+    ('NYSE', 'KO'), ('NYSE', 'DOW'), ('NYSE', 'GS'), ('NYSE', 'HD'),
+    ('ISLAND', 'HON'), ('NYSE', 'IBM'), ('ISLAND', 'INTC'), ('NYSE', 'JNJ'),
+    ('NYSE', 'JPM'), ('NYSE', 'MCD'), ('NYSE', 'MRK'), ('ISLAND', 'MSFT'),
+    ('NYSE', 'NKE'), ('NYSE', 'PG'), ('NYSE', 'CRM'), ('NYSE', 'TRV'),
+    ('NYSE', 'UNH'), ('NYSE', 'VZ'), ('NYSE', 'V'), ('ISLAND', 'WBA'),
+    ('NYSE', 'WMT'), ('NYSE', 'DIS'))
+
+# SP500 stocks which are downloaded from NYSE instead of SMART:
+NYSE_EXCHANGE: frozenset[str] = frozenset({'AAL', 'CSCO', 'KEYS', 'LIN', 'META', 'MNST', 'WELL'})
+
+# SP500 stocks which are not downloaded:
+DISABLED: frozenset[str] = frozenset({'VICI'})
+
+# Max. age in seconds of the local copy of wikipedia tables:
+wiki_cache_age = 86400
+
+# Timeout in seconds for downloading wikipedia pages:
+wiki_timeout = 30
+
+# Read a table from wikipedia. A copy is kept within csv_dir and is
+# only downloaded again if older than one day and changed on wikipedia.
+# If the download fails, an existing copy is used regardless of its age.
+@functools.lru_cache
+def read_wiki_table(url, index, cache_name) -> pandas.DataFrame:
+    import io
+    import urllib.request
+    import urllib.error
+    import email.utils
+    cache_file = None
+    if csv_dir and os.path.isdir(csv_dir):
+        cache_file = os.path.join(csv_dir, '.wiki_%s.parquet' % cache_name)
+    headers = {'User-Agent': 'tws-api-examples'}
+    if cache_file and os.path.exists(cache_file):
+        mtime = os.path.getmtime(cache_file)
+        if time.time() - mtime < wiki_cache_age:
+            return pandas.read_parquet(cache_file)
+        headers['If-Modified-Since'] = email.utils.formatdate(mtime, usegmt=True)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+            timeout=wiki_timeout) as response:
+            html = response.read().decode('utf-8')
+    except OSError as e: # also urllib.error.URLError and timeouts
+        if not cache_file or not os.path.exists(cache_file):
+            raise
+        if isinstance(e, urllib.error.HTTPError) and e.code == 304:
+            os.utime(cache_file)
+        else:
+            print('Download of %s failed, using old copy: %s' % (url, e))
+        return pandas.read_parquet(cache_file)
+    df = pandas.read_html(io.StringIO(html))[index]
+    if cache_file:
+        df.to_parquet(cache_file)
+    return df
+
 # Read all companies of the SP500 from wikipedia.
 def read_sp500() -> pandas.DataFrame:
-    table = pandas.read_html('https://en.wikipedia.org/wiki/List_of_S%26P_500_companies')
-    df = table[0]
+    df = read_wiki_table('https://en.wikipedia.org/wiki/List_of_S%26P_500_companies',
+        0, 'sp500')
     #print(df.info())
     #df.drop('SEC filings', axis=1, inplace=True)
     return df
@@ -132,8 +195,7 @@ def print_sp500() -> None:
     # XXX print REITS: df['GICS Sector'] == 'Real Estate'
 
 def read_nasdaq100() -> pandas.DataFrame:
-    table = pandas.read_html('https://en.wikipedia.org/wiki/NASDAQ-100')
-    df = table[4]
+    df = read_wiki_table('https://en.wikipedia.org/wiki/NASDAQ-100', 4, 'nasdaq100')
     return df
 
 def print_nasdaq100() -> None:
@@ -144,36 +206,58 @@ def print_nasdaq100() -> None:
     p = pprint.pformat(symbols, width=79, compact=True, indent=4)
     print(p)
 
-# CSV datafiles (and also used for sql database):
+# CSV/Parquet datafiles (and also used for sql database):
 #csv_dir = None
 csv_dir = 'data'
 
+# Store data as gzip compressed CSV files instead of Parquet:
+use_csv = False
+
 sql_filename = 'IB.db'
 
+# csv_dir as pathlib.Path, set by open_db():
+csv_base = None
+
 # database engine:
 engine = None
 
 def open_db():
-    global engine
+    global engine, csv_base
     if not csv_dir:
         return True
-    if not os.path.isdir(csv_dir):
+    csv_base = pathlib.Path(csv_dir)
+    if not csv_base.is_dir():
         print('Directory %s does not exist, please create it.' % csv_dir)
         return False
-    use_sqlalchemy = False
-    if not use_sqlalchemy:
-        import sqlite3
-        #db_file = ':memory:'
-        db_file = os.path.join(csv_dir, sql_filename)
-        engine = sqlite3.connect(db_file)
-    else:
-        from sqlalchemy import create_engine
-        #db_file = 'sqlite:///:memory:'
-        #db_file = 'sqlite:///data/' + sql_filename
-        db_file = os.path.join('sqlite:///' + csv_dir, sql_filename)
-        engine = create_engine(db_file)
+    import sqlite3
+    #db_file = ':memory:'
+    db_file = csv_base / sql_filename
+    engine = sqlite3.connect(db_file)
+    # Fewer fsyncs, data is committed once per stock:
+    engine.execute('PRAGMA journal_mode=WAL')
+    engine.execute('PRAGMA synchronous=NORMAL')
+    engine.execute('PRAGMA temp_store=MEMORY')
+    create_db_tables()
     return True
 
+# All data is stored in one table per timespan. Hourly data is downloaded
+# on a per-year basis, the year of the download is stored with each bar.
+def create_db_tables():
+    for timespan in ('weekly', 'daily', 'hourly'):
+        year = 'year INTEGER, ' if timespan == 'hourly' else ''
+        engine.execute('CREATE TABLE IF NOT EXISTS bars_%s (' % timespan +
+            'symbol TEXT, exchange TEXT, %sdate TEXT, ' % year +
+            'open REAL, high REAL, low REAL, close REAL, volume REAL, ' +
+            'average REAL, barCount INTEGER, ' +
+            'PRIMARY KEY (symbol, exchange, date))')
+    engine.execute('CREATE INDEX IF NOT EXISTS bars_hourly_year ' +
+        'ON bars_hourly (symbol, exchange, year)')
+    engine.commit()
+
+def commit_db():
+    if engine:
+        engine.commit()
+
 def close_db():
     global engine
     if not csv_dir:
@@ -181,15 +265,57 @@ def close_db():
     engine.close()
     engine = None
 
-tables = []
+# Table names (see getTableName()) of all data stored in the database:
+tables: set[str] = set()
+
+# Snapshot of all filenames within csv_dir:
+existing_files: set[str] = set()
 
-# Get a list of available database tables.
+# Get a set of table names of all data stored in the database.
 def getDbTables():
     if not engine:
-        return []
-    dbcurr = engine.cursor()
-    dbcurr.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    return [table[0] for table in dbcurr.fetchall()]
+        return set()
+    ret = set()
+    for timespan in ('weekly', 'daily'):
+        dbcurr = engine.execute('SELECT DISTINCT symbol, exchange FROM bars_%s' % timespan)
+        ret.update(getTableName(stock, exchange, 0, timespan, True)
+            for stock, exchange in dbcurr)
+    dbcurr = engine.execute('SELECT DISTINCT symbol, exchange, year FROM bars_hourly')
+    ret.update(getTableName(stock, exchange, year, 'hourly', False)
+        for stock, exchange, year in dbcurr)
+    return ret
+
+# Get a set of all filenames within csv_dir, including the year
+# partitions of Parquet datasets (see getDataKey()).
+def getExistingFiles():
+    if not csv_dir:
+        return set()
+    ret = set()
+    with os.scandir(csv_dir) as it:
+        for entry in it:
+            ret.add(entry.name)
+            if entry.name.endswith('.parquet') and entry.is_dir():
+                with os.scandir(entry.path) as it2:
+                    ret.update('%s/%s' % (entry.name, e.name) for e in it2)
+    return ret
+
+# Replace the stored bars of one stock (and year for hourly data) with the dataframe.
+# Changes are not committed, this is done once per stock in writeIT().
+def writeDbBars(stock, exchange, year, timespan, onetable, df):
+    db_table = 'bars_' + timespan
+    if onetable:
+        key = (stock, exchange)
+        engine.execute('DELETE FROM %s WHERE symbol=? AND exchange=?' % db_table, key)
+    else:
+        key = (stock, exchange, year)
+        engine.execute('DELETE FROM %s WHERE symbol=? AND exchange=? AND year=?' % db_table,
+            key)
+    columns = ['symbol', 'exchange', 'year'][:len(key)] + [df.index.name] + list(df.columns)
+    # Hourly data of one year can contain some hours of the previous year:
+    engine.executemany('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (db_table,
+        ', '.join(columns), ', '.join('?' * len(columns))),
+        (key + (date,) + row for date, row in zip(formatDates(df),
+            df.itertuples(index=False, name=None))))
 
 # weekly and daily data is in one big file, everything else is stored
 # on a per-year basis
@@ -200,47 +326,167 @@ def getTableName(stock, exchange, year, timespan, onetable):
 
 # CSV filename, compressed with gzip
 def getCsvFilename(table_name):
-    return os.path.join(csv_dir, table_name + '.csv.gz')
+    return csv_base / f'{table_name}.csv.gz'
+
+# Parquet filename
+def getFilename(table_name):
+    return csv_base / f'{table_name}.parquet'
+
+# Filename of the datafile depending on the selected fileformat.
+def getDataFilename(table_name):
+    if use_csv:
+        return getCsvFilename(table_name)
+    return getFilename(table_name)
+
+# Name of the data within csv_dir as stored in existing_files.
+# Yearly data is stored in Parquet as one dataset per stock, which is
+# partitioned into one directory per year.
+def getDataKey(stock, exchange, year, timespan, onetable):
+    table_name = getTableName(stock, exchange, year, timespan, onetable)
+    if use_csv:
+        return table_name + '.csv.gz'
+    if onetable:
+        return table_name + '.parquet'
+    return '%s.parquet/year=%d' % (getTableName(stock, exchange, year, timespan, True), year)
+
+# Year of the first (oldest) entry within a datafile.
+def getFirstYear(csv_file):
+    if use_csv:
+        # Only parse the first data line:
+        import gzip
+        import csv
+        with gzip.open(csv_file, 'rt') as f:
+            reader = csv.reader(f)
+            next(reader)
+            return int(next(reader)[0][:4])
+    # The min value of the date column is stored within the Parquet footer:
+    import pyarrow.parquet
+    pf = pyarrow.parquet.ParquetFile(csv_file)
+    column = pf.metadata.row_group(0).column(pf.schema.names.index('date'))
+    if column.is_stats_set and column.statistics.has_min_max:
+        return column.statistics.min.year
+    dates = pf.read_row_group(0, columns=['date']).column('date')
+    return dates[0].as_py().year
+
+# Fields of ib_async.BarData:
+BAR_FIELDS = ('date', 'open', 'high', 'low', 'close', 'volume', 'average', 'barCount')
+_bar_getter = operator.attrgetter(*BAR_FIELDS)
 
 # Convert IB data into pandas dataframe (df).
 def ConvertIB2Dataframe(bars):
-    df = ib_async.util.df(bars)
-    df.set_index(['date'], inplace=True)
+    df = pandas.DataFrame.from_records(map(_bar_getter, bars), columns=BAR_FIELDS)
+    df['date'] = pandas.to_datetime(df['date'])
+    df.set_index('date', inplace=True)
     return df
 
-def writeIT2(ib, contract, stock, exchange, year, timespan, barSize, duration,
-    onetable, check=False):
+# Dates of a dataframe as strings, same format as written by df.to_csv():
+# '2015-01-05' for daily/weekly data, including the time for intraday data.
+def formatDates(df):
+    return df.index.astype(str).to_numpy(dtype=object)
+
+# Write a dataframe of bars (see ConvertIB2Dataframe()) as gzip compressed
+# CSV file. Same content as df.to_csv(), but formatted with one single
+# string operation instead of row by row.
+def _fast_write_bars(df, csv_file):
+    import gzip
+    arr = numpy.column_stack([formatDates(df)] +
+        [df[c].to_numpy() for c in BAR_FIELDS[1:]])
+    fmt = ','.join(['%s'] * len(BAR_FIELDS)) + '\n'
+    data = ','.join(BAR_FIELDS) + '\n' + (fmt * len(df)) % tuple(arr.ravel())
+    with gzip.GzipFile(csv_file, 'wb', compresslevel=1, mtime=0) as f:
+        f.write(data.encode())
+
+# Max. number of concurrent historical data requests sent to TWS:
+max_requests = 45
+
+# Semaphore to limit the number of concurrent requests:
+request_sem = None
+
+# Max. number of requests for one contract within pacing_time seconds.
+# IB treats six or more requests for the same contract within two seconds
+# as pacing violation and returns no data.
+max_contract_requests = 5
+pacing_time = 2
+
+# Download data if not yet stored locally, returns a dataframe or None.
+# contract_sem limits the requests per contract, see max_contract_requests.
+async def fetchIT(ib, contract, contract_sem, stock, exchange, year, timespan, barSize,
+    duration, onetable, check=False):
     table_name = getTableName(stock, exchange, year, timespan, onetable)
     exist = True
     if csv_dir:
-        csv_file = getCsvFilename(table_name)
-        if not os.path.exists(csv_file):
+        if getDataKey(stock, exchange, year, timespan, onetable) not in existing_files:
             exist = False
     if engine and table_name not in tables:
         exist = False
     if check:
         exist = False
     if exist:
-        return
-    if onetable:
-        print(stock, timespan)
-    else:
-        print(stock, year, timespan)
-    bars = ib.reqHistoricalData(contract, endDateTime='%d0101 00:00:00 UTC' % (year + 1),
-        durationStr=duration, barSizeSetting=barSize, whatToShow='TRADES', # MIDPOINT
-        useRTH=True) #, formatDate=1)
+        return None
+    async with contract_sem:
+        async with request_sem:
+            start = time.monotonic()
+            if onetable:
+                print(stock, timespan)
+            else:
+                print(stock, year, timespan)
+            bars = await ib.reqHistoricalDataAsync(contract,
+                endDateTime='%d0101 00:00:00 UTC' % (year + 1),
+                durationStr=duration, barSizeSetting=barSize, whatToShow='TRADES', # MIDPOINT
+                useRTH=True) #, formatDate=1)
+        # Keep the slot until pacing_time is over:
+        await asyncio.sleep(pacing_time - (time.monotonic() - start))
     if not bars:
-        return
-    df = ConvertIB2Dataframe(bars)
-    # Save into CSV file and sql database:
-    if csv_dir:
-        df.to_csv(csv_file)
-    if engine: # and table_name not in tables:
-        df.to_sql(table_name, engine, if_exists='replace')
-        if table_name not in tables:
-            tables.append(table_name)
+        return None
+    return ConvertIB2Dataframe(bars)
 
-def writeIT(ib, stock, exchange, currency, hourly=True):
+# Save into CSV file and sql database. Parquet files for yearly data
+# are written by storeYearly().
+def storeIT(stock, exchange, year, timespan, onetable, df):
+    table_name = getTableName(stock, exchange, year, timespan, onetable)
+    if csv_dir and (use_csv or onetable):
+        csv_file = getDataFilename(table_name)
+        if use_csv:
+            if df.index.name == BAR_FIELDS[0] and tuple(df.columns) == BAR_FIELDS[1:]:
+                _fast_write_bars(df, csv_file)
+            else:
+                # fast compression, mtime=0 gives reproducible files:
+                df.to_csv(csv_file,
+                    compression={'method': 'gzip', 'compresslevel': 1, 'mtime': 0})
+        else:
+            df.to_parquet(csv_file, engine='pyarrow', compression='snappy')
+        existing_files.add(getDataKey(stock, exchange, year, timespan, onetable))
+    if engine: # and table_name not in tables:
+        writeDbBars(stock, exchange, year, timespan, onetable, df)
+        tables.add(table_name)
+
+# Save the yearly dataframes {year: df} of one stock. For Parquet they
+# are written at once into one dataset partitioned by year, which can be
+# read e.g. via pandas.read_parquet(filename, filters=[('year', '==', 2023)]).
+def storeYearly(stock, exchange, timespan, frames):
+    for year, df in frames.items():
+        storeIT(stock, exchange, year, timespan, False, df)
+    if csv_dir and not use_csv and frames:
+        table_name = getTableName(stock, exchange, 0, timespan, True)
+        df = pandas.concat([df.assign(year=year) for year, df in frames.items()])
+        df.to_parquet(getFilename(table_name), engine='pyarrow', compression='snappy',
+            partition_cols=['year'], existing_data_behavior='delete_matching')
+        existing_files.update(getDataKey(stock, exchange, year, timespan, False)
+            for year in frames)
+
+# Downloads run concurrently, but all writes to disk and to the database are
+# done without awaiting anything, so they are serialized by the event loop.
+async def writeIT2(ib, contract, contract_sem, stock, exchange, year, timespan, barSize,
+    duration, onetable, check=False):
+    df = await fetchIT(ib, contract, contract_sem, stock, exchange, year, timespan, barSize,
+        duration, onetable, check)
+    if df is not None:
+        storeIT(stock, exchange, year, timespan, onetable, df)
+
+# Current year, determined once at startup:
+CUR_YEAR = time.localtime().tm_year
+
+async def writeIT(ib, stock, exchange, currency, hourly=True, cur_year=CUR_YEAR):
     contract = ib_async.Stock(stock, exchange, currency)
     #details = ib.reqContractDetails(contract)
     #print(details)
@@ -251,73 +497,71 @@ def writeIT(ib, stock, exchange, currency, hourly=True):
     #if details.exchange != exchange:
     #    raise
     # XXX: write down time of fetching/checking data
-    cur_year = int(time.strftime('%Y'))
-    writeIT2(ib, contract, stock, exchange, cur_year, 'weekly', '1 week', '40 Y', True)
-    writeIT2(ib, contract, stock, exchange, cur_year, 'daily', '1 day', '40 Y', True)
+    contract_sem = asyncio.Semaphore(max_contract_requests)
+    await asyncio.gather(
+        writeIT2(ib, contract, contract_sem, stock, exchange, cur_year, 'weekly', '1 week',
+            '40 Y', True),
+        writeIT2(ib, contract, contract_sem, stock, exchange, cur_year, 'daily', '1 day',
+            '40 Y', True))
     if not hourly:
+        commit_db()
         return
     # Find first year of data:
     startYear = 1980
     if csv_dir:
         table_name = getTableName(stock, exchange, cur_year, 'weekly', True)
-        csv_file = getCsvFilename(table_name)
-        wk = pandas.read_csv(csv_file) # index_col='Date')
-        startYear = int(wk['date'][0][:4])
+        startYear = getFirstYear(getDataFilename(table_name))
     # Download yearly data:
-    for year in range(cur_year, startYear - 1, -1):
-        #writeIT2(ib, contract, stock, exchange, year, 'daily', '1 day', '1 Y', False)
-        if year >= 2004 and hourly:
-            writeIT2(ib, contract, stock, exchange, year, 'hourly', '1 hour', '1 Y', False)
-
-def write_some_stocks(ib):
-    writeIT(ib, 'AAPL', 'SMART', 'USD')
-    writeIT(ib, 'TSLA', 'SMART', 'USD')
-    writeIT(ib, 'TSLA', 'NYSE', 'USD')
-    writeIT(ib, 'TSLA', 'ISLAND', 'USD')
-
-def write_some_stocks2(ib):
+    years = range(cur_year, max(startYear, 2004) - 1, -1)
+    dfs = await asyncio.gather(*(fetchIT(ib, contract, contract_sem, stock, exchange, year,
+        'hourly', '1 hour', '1 Y', False) for year in years))
+    storeYearly(stock, exchange, 'hourly',
+        {year: df for year, df in zip(years, dfs) if df is not None})
+    commit_db()
+
+# All following functions return download jobs as tuples of
+# (stock, exchange, currency, hourly), see writeIT().
+
+def some_stocks():
+    return (('AAPL', 'SMART', 'USD', True),
+        ('TSLA', 'SMART', 'USD', True),
+        ('TSLA', 'NYSE', 'USD', True),
+        ('TSLA', 'ISLAND', 'USD', True))
+
+def some_stocks2():
     # CSCO FTRCQ IEP RDS.B
     stocks = ['APLE', 'BTI', 'CIM', 'D', 'DUK', 'ENB', 'EPD',
         'EPR', 'ETRN', 'FAX', 'GE', 'GTY', 'HBI', 'JNJ', 'KHC', 'LMT',
         'LTC', 'M', 'MA', 'MAIN', 'MMM', 'MMP', 'MO', 'MPW', 'OPI',
         'OZK', 'PM', 'PPL', 'PRU', 'SKT', 'TEVA', 'TSN', 'UHS', 'V',
         'VLO', 'WB', 'WSR']
-    for stock in stocks:
-        writeIT(ib, stock, 'SMART', 'USD')
+    return ((stock, 'SMART', 'USD', True) for stock in stocks)
 
-# https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average
-def write_dow_stocks(ib):
-    dow = ['NYSE:MMM', 'NYSE:AXP', 'AMGN', 'AAPL', 'NYSE:BA', 'NYSE:CAT', 'NYSE:CVX', 'CSCO',
-        'NYSE:KO', 'NYSE:DOW', 'NYSE:GS', 'NYSE:HD', 'HON', 'NYSE:IBM', 'INTC',
-        'NYSE:JNJ', 'NYSE:JPM', 'NYSE:MCD', 'NYSE:MRK', 'MSFT', 'NYSE:NKE', 'NYSE:PG',
-        'NYSE:CRM', 'NYSE:TRV', 'NYSE:UNH', 'NYSE:VZ', 'NYSE:V', 'WBA', 'NYSE:WMT', 'NYSE:DIS']
-    for stock in dow:
-        #exchange = 'SMART'
-        exchange = 'ISLAND'
-        #exchange = 'NASDAQ'
-        if stock[:5] == 'NYSE:':
-            stock = stock[5:]
-            exchange = 'NYSE'
-        writeIT(ib, stock, exchange, 'USD', False)
-
-def write_sp500_stocks(ib):
-    nyse = ['AAL', 'CSCO', 'KEYS', 'LIN', 'META', 'MNST', 'WELL']
-    disable = ['VICI',]
-    for stock in SP500:
-        stock = stock.replace('.', ' ')
-        exchange = 'SMART'
-        if stock in nyse:
-            exchange = 'NYSE'
-        if stock in disable:
-            continue
-        writeIT(ib, stock, exchange, 'USD', False)
-
-def write_nasdaq_stocks(ib):
+def dow_stocks():
+    return ((stock, exchange, 'USD', False) for exchange, stock in DOW)
+
+def sp500_stocks():
+    return ((stock, 'NYSE' if stock in NYSE_EXCHANGE else 'SMART', 'USD', False)
+        for stock in SP500_NORMALIZED if stock not in DISABLED)
+
+def nasdaq_stocks():
     # https://en.wikipedia.org/wiki/NASDAQ-100#Components
-    for stock in NASDAQ100:
-        exchange = 'ISLAND'
-        #exchange = 'NASDAQ'
-        writeIT(ib, stock, exchange, 'USD', False)
+    #exchange = 'NASDAQ'
+    return ((stock, 'ISLAND', 'USD', False) for stock in NASDAQ100)
+
+async def write_stocks(ib):
+    global request_sem
+    request_sem = asyncio.Semaphore(max_requests)
+    # Stocks contained in several indices are only downloaded once,
+    # a dict is used as set which keeps the order:
+    wanted = {}
+    #wanted.update(dict.fromkeys(some_stocks()))
+    #wanted.update(dict.fromkeys(some_stocks2()))
+    wanted.update(dict.fromkeys(dow_stocks()))
+    wanted.update(dict.fromkeys(sp500_stocks()))
+    wanted.update(dict.fromkeys(nasdaq_stocks()))
+    await asyncio.gather(*(writeIT(ib, stock, exchange, currency, hourly)
+        for stock, exchange, currency, hourly in wanted))
 
 def getSPX():
     return Index('SPX', 'CBOE', 'USD', description='SP500 Index')
@@ -352,12 +596,6 @@ def getMiniHSI():
 def getEURUSD():
     return Forex('EURUSD')
 
-def usage():
-    print('stock-hist-data-download.py ' +
-        '[--list-index][--data-dir=data]' +
-        '[--host=127.0.0.1][--port=7496][--client-id=0]' +
-        '[--help][--verbose][--debug][--quiet]')
-
 def show_account(ib):
     #print([v for v in ib.accountValues() if v.tag == 'NetLiquidationByCurrency' and v.currency == 'BASE'])
     if True:
@@ -385,70 +623,50 @@ def show_account(ib):
             for o in orders:
                 print(o)
 
-def main(argv):
-    global tables, csv_dir
-    import getopt
-    verbose = 1
+# log level for each verbose level:
+LOG_LEVELS = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)
 
+def main(argv):
+    global tables, existing_files, csv_dir, use_csv
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='stock-hist-data-download.py',
+        description='Download historical stock data from IB TWS.')
+    parser.add_argument('--list-index', action='store_true',
+        help='print SP500 and NASDAQ100 symbols from wikipedia and exit')
+    parser.add_argument('--data-dir', default=csv_dir,
+        help='directory for all data, "None" to not store data (default: %(default)s)')
+    parser.add_argument('--csv', action='store_true',
+        help='store gzip compressed CSV files instead of Parquet')
     # Connect params to your Interactive Brokers (IB) TWS or IB Gateway:
-    host = '127.0.0.1'
-    #port = 7497 # TWS paper account (demo/test)
-    port = 7496 # TWS active/real/live account
-    #port = 4002 # IB Gateway paper account (demo/test)
-    #port = 4001 # IB Gateway active/real/live account
-    client_id = 0
-
-    try:
-        opts, args = getopt.getopt(argv, 'dhqv', ['list-index', 'help',
-            'host=', 'port=', 'client-id='
-            'data-dir=', 'quiet', 'verbose', 'debug'])
-    except getopt.GetoptError:
-        usage()
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt in ('-h', '--help'):
-            usage()
-            sys.exit()
-        elif opt == '--data-dir':
-            if arg in ('', 'None'):
-                csv_dir = None
-            else:
-                csv_dir = arg
-        elif opt == '--list-index':
-            print_sp500()
-            print_nasdaq100()
-            sys.exit(0)
-        elif opt == '--host':
-            host = arg
-        elif opt == '--port':
-            port = int(arg)
-        elif opt == '--client-id':
-            client_id = int(arg)
-        elif opt in ('-v', '--verbose'):
-            verbose += 1
-        elif opt in ('-d', '--debug'):
-            verbose = 3
-        elif opt in ('-q', '--quiet'):
-            verbose = 0
-    #if len(args) == 0:
-    #    usage()
-    #    sys.exit()
+    parser.add_argument('--host', default='127.0.0.1')
+    # 7497: TWS paper account (demo/test)
+    # 7496: TWS active/real/live account
+    # 4002: IB Gateway paper account (demo/test)
+    # 4001: IB Gateway active/real/live account
+    parser.add_argument('--port', type=int, default=7496)
+    parser.add_argument('--client-id', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('-d', '--debug', action='store_const', const=3, dest='verbose')
+    parser.add_argument('-q', '--quiet', action='store_const', const=0, dest='verbose')
+    args = parser.parse_args(argv)
+
+    use_csv = args.csv
+    csv_dir = None if args.data_dir in ('', 'None') else args.data_dir
+    if args.list_index:
+        print_sp500()
+        print_nasdaq100()
+        sys.exit(0)
+    verbose = args.verbose
 
     ib_async.util.allowCtrlC()
 
-    if verbose == 0:
-        ib_async.util.logToConsole(logging.ERROR)
-    elif verbose == 1:
-        ib_async.util.logToConsole(logging.WARNING)
-    elif verbose == 2:
-        ib_async.util.logToConsole(logging.INFO)
-    elif verbose >= 3:
-        ib_async.util.logToConsole(logging.DEBUG)
+    ib_async.util.logToConsole(LOG_LEVELS[min(verbose, len(LOG_LEVELS) - 1)])
     #ib_async.util.logToFile("ib.log", logging.WARNING)
 
     ib = ib_async.IB()
     try:
-        ib.connect(host, port, clientId=client_id) # account
+        ib.connect(args.host, args.port, clientId=args.client_id) # account
     except ConnectionRefusedError:
         sys.exit(1)
 
@@ -457,14 +675,11 @@ def main(argv):
     if not open_db():
         sys.exit(3)
     tables = getDbTables()
+    existing_files = getExistingFiles()
     #print(tables)
     #trades = pd.read_sql(trades_query, self.dbconn)
 
-    #write_some_stocks(ib)
-    #write_some_stocks2(ib)
-    write_dow_stocks(ib)
-    write_sp500_stocks(ib)
-    write_nasdaq_stocks(ib)
+    ib_async.util.run(write_stocks(ib))
 
     #ib.sleep(10)
     ib.disconnect()